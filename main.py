@@ -1,19 +1,24 @@
 import os
-import json
+import re
+import math
 import time
 import hmac
-import hashlib
+import json
+import orjson
 import datetime as dt
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, Tuple
 import requests
+import httpx
 import asyncio
 import logging
-import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardRemove
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler
 from telegram.ext import filters
 from fastapi import FastAPI, Request, Header, HTTPException
+from fastapi.responses import ORJSONResponse
 import uvicorn
 from pydantic import BaseModel
 from typing import Union
@@ -33,38 +38,181 @@ ADMIN_CHANNEL_ID = os.getenv("ADMIN_CHANNEL_ID", "-1003095776330")  # ID of the
 
 NOWPAY_API = "https://api.nowpayments.io/v1"
 USDT_BSC_CODE = "USDTBSC"
+NOWPAY_MIN_AMOUNT_URL = f"{NOWPAY_API}/min-amount"
+NOWPAY_MIN_AMOUNT_PARAMS = {"currency_from": USDT_BSC_CODE, "currency_to": USDT_BSC_CODE}
+NOWPAY_PAYMENT_URL = f"{NOWPAY_API}/payment"
+CHANNEL_URL = f"https://t.me/{CHANNEL_USERNAME.lstrip('@')}"
+# Public endpoints of this service; None until BASE_URL is configured
+WEBHOOK_URL = f"{BASE_URL}/telegram/webhook" if BASE_URL else None
+IPN_CALLBACK_URL = f"{BASE_URL}/ipn/nowpayments" if BASE_URL else None
+PING_URL = f"{BASE_URL}/" if BASE_URL else None
 PACKAGES = {10: 0.33, 20: 0.66, 50: 1.66, 100: 3.33, 200: 6.66, 500: 16.66, 1000: 33.33}
 PACKAGE_DAYS = 60
+# Matches callback data for the known packages only, e.g. "pkg:100"
+PACKAGE_CALLBACK_RE = re.compile(rf"^pkg:({'|'.join(map(str, PACKAGES))})$")
 MIN_WITHDRAWAL = 1.5  # Minimum withdrawal amount
+UNITS_PER_USDT = 100_000_000  # Balances are stored as integer 1e-8 USDT units, so sums never drift
+IPN_MAX_BODY = 64 * 1024  # Real IPN payloads are well under 1 KB; larger bodies are rejected unhashed
+MIN_AMOUNT_TTL = 300  # Seconds to reuse the NOWPayments min-amount before refetching
+MIN_AMOUNT_RETRY = 30  # Seconds to serve the fallback after a failed fetch before trying again
+BOT_USERNAME: Optional[str] = None  # Filled in once the bot is initialized
+WEBHOOK_MAX_CONNECTIONS = 100  # Concurrent update deliveries Telegram may push (1-100)
+WEBHOOK_ALLOWED_UPDATES = ["message", "callback_query"]  # The only update types we have handlers for
+TELEGRAM_POOL_SIZE = 256  # Outbound Bot API connections; must stay above WEBHOOK_MAX_CONNECTIONS in-flight updates
+TELEGRAM_POOL_TIMEOUT = 5  # Seconds to wait for a free connection during bursts instead of failing after 1
+BLOCKING_IO_WORKERS = 16  # Threads available to asyncio.to_thread for blocking calls
+OUTBOUND_BATCH_SIZE = 30  # Queued messages sent per second; Telegram's global bot limit is ~30/s
+BOOTSTRAP_MAX_BACKOFF = 600  # Longest wait in seconds between bot startup retries
+USERS_LOG_COMPACT_AT = 10_000  # Journal entries before they are folded into a fresh users.json
+
+# Logging setup
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
 
 # Persistent storage for users and processed orders
 try:
-    with open("users.json", "r") as f:
-        users: Dict[int, Dict[str, Any]] = {int(k): v for k, v in json.load(f).items()}
-except (FileNotFoundError, json.JSONDecodeError, ValueError):
-    users: Dict[int, Dict[str, Any]] = {}  # uid: {"balance": 0.0, "verified": False, "referrer_id": None, "packages": [], "first_package_activated": False, "withdraw_state": None}
+    with open("users.json", "rb") as f:
+        _snapshot = f.read()
+    try:
+        _snapshot = orjson.loads(_snapshot)
+    except orjson.JSONDecodeError:
+        # Snapshots saved by json.dump can contain NaN, which orjson rejects. An unreadable
+        # users.json must stop startup: loading {} would let the next save wipe every account.
+        _snapshot = json.loads(_snapshot)
+    users: Dict[int, Dict[str, Any]] = {int(k): v for k, v in _snapshot.items()}
+except FileNotFoundError:
+    users: Dict[int, Dict[str, Any]] = {}  # uid: {"balance": 0, "verified": False, "referrer_id": None, "packages": [], "first_package_activated": False, "withdraw_state": None}
 
 try:
-    with open("processed_orders.json", "r") as f:
-        processed_orders = set(json.load(f))
-except (FileNotFoundError, json.JSONDecodeError):
+    with open("processed_orders.json", "rb") as f:
+        processed_orders = set(orjson.loads(f.read()))
+except (FileNotFoundError, orjson.JSONDecodeError):
     processed_orders = set()  # Default to empty set if file doesn’t exist or is invalid
 
-# Logging setup
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
+# Orders are only ever added, so new ones are appended one per line instead of
+# rewriting processed_orders.json, which is now only read for older deployments
+try:
+    with open("processed_orders.log", "rb") as f:
+        _orders_tail = b""
+        for line in f:
+            if line.endswith(b"\n"):
+                processed_orders.add(line[:-1].decode("utf-8"))
+            _orders_tail = line
+except FileNotFoundError:
+    _orders_tail = b""
+_orders_log = open("processed_orders.log", "ab", buffering=0)
+if _orders_tail and not _orders_tail.endswith(b"\n"):
+    _orders_log.write(b"\n")  # Terminate a torn last line so the next entry starts cleanly
+
+# Shared keep-alive pool for NOWPayments calls, opened and closed with the server.
+# The API key travels as a default header so individual calls only pass their own params.
+NOWPAY_CLIENT: Optional[httpx.AsyncClient] = None
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    global NOWPAY_CLIENT
+    # Bound the threads blocking calls can spawn via asyncio.to_thread
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=BLOCKING_IO_WORKERS))
+    NOWPAY_CLIENT = httpx.AsyncClient(
+        headers={"x-api-key": NOWPAY_API_KEY or ""},
+        timeout=30,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+    )
+    tasks = []
+    try:
+        # The bot is set up in the background so the server answers (IPNs, health checks)
+        # even while Telegram is unreachable
+        tasks.append(asyncio.create_task(bootstrap_app()))
+        tasks.append(asyncio.create_task(ping_self()))
+        tasks.append(asyncio.create_task(drain_outbound()))
+        yield
+    finally:
+        for task in tasks:
+            task.cancel()
+        if app.running:
+            await app.stop()
+        await app.shutdown()
+        await NOWPAY_CLIENT.aclose()
+        # Fold the journal into users.json so the next start has nothing to replay
+        save_users()
 
-api = FastAPI()
+api = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 # ----------------- MEMORY UTILITIES -----------------
+# users.json is a snapshot; every change since then is a full user record appended to users.log
+_users_log_lines = 0
+
+def to_units(amount: float) -> int:
+    # round, not int: 0.29 * 1e8 is 28999999.999999996
+    return round(amount * UNITS_PER_USDT)
+
+def from_units(units: int) -> float:
+    return units / UNITS_PER_USDT
+
 def save_users():
-    with open("users.json", "w") as f:
-        json.dump(users, f)
+    # Full snapshot, which makes the journal redundant. It is written to a temp file,
+    # synced and renamed over users.json, so a crash leaves either the old or the new
+    # snapshot, and the journal is only cleared once the new one is on disk.
+    global _users_log_lines
+    with open("users.json.tmp", "wb") as f:
+        f.write(orjson.dumps(users, option=orjson.OPT_NON_STR_KEYS))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace("users.json.tmp", "users.json")
+    _users_log.truncate(0)
+    _users_log_lines = 0
+
+def save_user(uid: int):
+    # O(1) persistence for a single user: append its record to the journal
+    global _users_log_lines
+    _users_log.write(orjson.dumps({"uid": uid, "user": users[uid]}) + b"\n")
+    _users_log_lines += 1
+    if _users_log_lines >= USERS_LOG_COMPACT_AT:
+        save_users()
+
+# Replay what was journaled since the last snapshot, then fold it into a fresh one.
+# This also drops a torn last line left by a crash, so new entries never follow it.
+_replayed = False
+try:
+    with open("users.log", "rb") as f:
+        for line in f:
+            _replayed = True
+            try:
+                entry = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                break
+            users[int(entry["uid"])] = entry["user"]
+except FileNotFoundError:
+    pass
+_users_log = open("users.log", "ab", buffering=0)
+# Older snapshots and journal entries hold balances as float USDT. A withdrawal of "nan"
+# used to store a NaN balance (orjson journals it as null); those can't be converted
+# and are reset to 0.
+_migrated = False
+for _uid, _u in users.items():
+    _bal = _u.get("balance")
+    if isinstance(_bal, int):
+        continue
+    if isinstance(_bal, float) and math.isfinite(_bal * UNITS_PER_USDT):
+        _u["balance"] = to_units(_bal)
+    else:
+        logger.warning(f"Resetting invalid balance {_bal!r} of user {_uid} to 0")
+        _u["balance"] = 0
+    _migrated = True
+if _replayed or _migrated:
+    save_users()
+
+# referrer uid -> number of referred users who activated a package; kept in step with
+# ensure_user/activate_package so /my_team and withdrawals don't scan every user
+qualified_referrals: Dict[int, int] = {}
+for _u in users.values():
+    if _u.get("referrer_id") and _u.get("first_package_activated", False):
+        qualified_referrals[_u["referrer_id"]] = qualified_referrals.get(_u["referrer_id"], 0) + 1
 
 def ensure_user(uid: int, referrer_id: Optional[int] = None):
     if uid not in users:
         users[uid] = {
-            "balance": 0.0,
+            "balance": 0,
             "verified": False,
             "referrer_id": referrer_id,
             "packages": [],
@@ -72,70 +220,99 @@ def ensure_user(uid: int, referrer_id: Optional[int] = None):
             "withdraw_state": None,
             "deposit_address": None  # Add deposit_address to store the first generated address
         }
-        save_users()
+        save_user(uid)
     elif referrer_id and not users[uid].get("referrer_id"):
         users[uid]["referrer_id"] = referrer_id
-        save_users()
+        if users[uid].get("first_package_activated", False):
+            qualified_referrals[referrer_id] = qualified_referrals.get(referrer_id, 0) + 1
+        save_user(uid)
 
 def get_user(uid: int) -> Dict[str, Any]:
-    ensure_user(uid)
-    return users[uid]
+    user = users.get(uid)
+    if user is None:
+        ensure_user(uid)
+        user = users[uid]
+    return user
 
-def add_balance(uid: int, amount: float):
+def add_balance(uid: int, units: int):
     if uid in users:
-        users[uid]["balance"] = round(users[uid]["balance"] + amount, 8)
-        save_users()
+        users[uid]["balance"] += units
+        save_user(uid)
 
-def deduct_balance(uid: int, amount: float) -> bool:
+def deduct_balance(uid: int, units: int) -> bool:
     if uid in users:
-        cur = users[uid]["balance"]
-        if cur + 1e-9 < amount:
+        if users[uid]["balance"] < units:
             return False
-        users[uid]["balance"] = round(cur - amount, 8)
-        save_users()
+        users[uid]["balance"] -= units
+        save_user(uid)
         return True
     return False
 
-def append_package(uid: int, pack: Dict[str, Any]):
-    if uid in users:
-        users[uid]["packages"].append(pack)
-        save_users()
+def activate_package(uid: int, pack: Dict[str, Any]) -> bool:
+    # Deduct the price, add the package and pay the first-package referral bonus
+    # as one change, written with a single save per user touched
+    user = users.get(uid)
+    if user is None:
+        return False
+    price = to_units(pack["price"])
+    if user["balance"] < price:
+        return False
+    user["balance"] -= price
+    user["packages"].append(pack)
+    if not user.get("first_package_activated"):
+        refid = user.get("referrer_id")
+        if refid:
+            qualified_referrals[refid] = qualified_referrals.get(refid, 0) + 1
+        if refid in users:
+            users[refid]["balance"] += price // 10
+            save_user(refid)
+        user["first_package_activated"] = True
+    save_user(uid)
+    return True
 
-def active_packages(user: Dict[str, Any]) -> List[Dict[str, Any]]:
-    now = dt.datetime.now(dt.UTC)
-    out = []
-    for p in user.get("packages", []):
-        if dt.datetime.fromtimestamp(p["end_ts"], dt.UTC) > now:
-            out.append(p)
-    return out
+def active_packages(user: Dict[str, Any], now_ts: int) -> List[Dict[str, Any]]:
+    # end_ts is stored as epoch seconds, so compare ints instead of building datetimes
+    return [p for p in user.get("packages", []) if p["end_ts"] > now_ts]
 
 # ----------------- NOWPAYMENTS -----------------
-def get_min_amount():
-    url = f"{NOWPAY_API}/min-amount"
-    headers = {"x-api-key": NOWPAY_API_KEY}
-    params = {"currency_from": USDT_BSC_CODE, "currency_to": USDT_BSC_CODE}
-    try:
-        resp = requests.get(url, headers=headers, params=params, timeout=10)
-        resp.raise_for_status()
-        return float(resp.json().get('min_amount', 5.0))
-    except Exception:
-        return 5.0
-
-def nowpayments_create_payment(user_id: int) -> Dict[str, Any]:
+_MIN_AMOUNT_CACHE = {"value": None, "expires": 0.0}
+_MIN_AMOUNT_LOCK = asyncio.Lock()
+
+async def get_min_amount():
+    if time.monotonic() < _MIN_AMOUNT_CACHE["expires"]:
+        return _MIN_AMOUNT_CACHE["value"]
+    async with _MIN_AMOUNT_LOCK:
+        # Concurrent misses wait here and reuse the value fetched by the first one
+        if time.monotonic() < _MIN_AMOUNT_CACHE["expires"]:
+            return _MIN_AMOUNT_CACHE["value"]
+        try:
+            resp = await NOWPAY_CLIENT.get(NOWPAY_MIN_AMOUNT_URL, params=NOWPAY_MIN_AMOUNT_PARAMS, timeout=10)
+            resp.raise_for_status()
+            value = float(resp.json().get('min_amount', 5.0))
+        except Exception:
+            # Prefer the last good value over the hardcoded default while NOWPayments is failing
+            # for a short while, so queued /deposit calls don't each wait out their own timeout
+            stale = _MIN_AMOUNT_CACHE["value"]
+            _MIN_AMOUNT_CACHE["value"] = stale if stale is not None else 5.0
+            _MIN_AMOUNT_CACHE["expires"] = time.monotonic() + MIN_AMOUNT_RETRY
+            return _MIN_AMOUNT_CACHE["value"]
+        _MIN_AMOUNT_CACHE["value"] = value
+        _MIN_AMOUNT_CACHE["expires"] = time.monotonic() + MIN_AMOUNT_TTL
+        return value
+
+async def nowpayments_create_payment(user_id: int) -> Dict[str, Any]:
     if not BASE_URL:
         raise ValueError("BASE_URL not set for payment creation")
-    url = f"{NOWPAY_API}/payment"
-    headers = {"x-api-key": NOWPAY_API_KEY, "Content-Type": "application/json"}
-    min_amt = get_min_amount()
+    min_amt = await get_min_amount()
     payload = {
         "price_amount": min_amt,
         "price_currency": USDT_BSC_CODE,
         "pay_currency": USDT_BSC_CODE,
         "order_id": f"{user_id}-{int(time.time())}",
-        "ipn_callback_url": f"{BASE_URL}/ipn/nowpayments"
+        "ipn_callback_url": IPN_CALLBACK_URL
     }
     try:
-        resp = requests.post(url, headers=headers, json=payload, timeout=30)
+        resp = await NOWPAY_CLIENT.post(NOWPAY_PAYMENT_URL, json=payload)
         resp.raise_for_status()
         logger.info(f"Created payment for user {user_id} with order_id {payload['order_id']}")
         return resp.json()
@@ -143,33 +320,86 @@ def nowpayments_create_payment(user_id: int) -> Dict[str, Any]:
         logger.error(f"Error creating payment for user {user_id}: {str(e)}")
         raise
 
-def verify_nowpay_signature(raw_body: bytes, signature: str) -> bool:
+# Encoded once at import. hmac.digest runs the whole HMAC in one OpenSSL call, which uses
+# the CPU's SHA-512 instructions (x86 SHA512 extensions, ARMv8 sha512) when available.
+_IPN_SECRET = NOWPAY_IPN_SECRET.encode("utf-8") if NOWPAY_IPN_SECRET else None
+
+# Returns the parsed body alongside the verdict so the IPN handler doesn't parse it again
+def verify_nowpay_signature(raw_body: bytes, signature: str, secret: Optional[bytes] = _IPN_SECRET) -> Tuple[bool, Optional[Dict[str, Any]]]:
+    if secret is None:
+        return False, None
     try:
-        body = json.loads(raw_body.decode("utf-8"))
-        sorted_body = json.dumps(body, separators=(",", ":"), sort_keys=True)
-        digest = hmac.new(NOWPAY_IPN_SECRET.encode("utf-8"), sorted_body.encode("utf-8"), hashlib.sha512).hexdigest()
-        return digest == signature
+        body = json.loads(raw_body)
+        # NOWPayments signs the key-sorted compact JSON, not the raw bytes, exactly as the stdlib
+        # writes it: \u-escaped non-ASCII and Python's float spelling (1e-05, 1e+16). orjson's
+        # output differs on both, so it can't be used here.
+        sorted_body = json.dumps(body, separators=(",", ":"), sort_keys=True).encode("utf-8")
+        digest = hmac.digest(secret, sorted_body, "sha512")
+        return hmac.compare_digest(digest, bytes.fromhex(signature)), body
     except Exception:
-        return False
+        return False, None
+
+# An IPN signed the way NOWPayments' Python sample does, with a non-ASCII description and
+# amounts that exercise float spelling; checked at startup so the canonical form can't drift
+_IPN_SAMPLE_SECRET = b"test-ipn-secret"
+_IPN_SAMPLE_BODY = (
+    '{"payment_id":5077125051,"payment_status":"finished","pay_address":"0xabc","price_amount":10,'
+    '"price_currency":"usdtbsc","pay_amount":10.000001,"actually_paid":0.00001,"pay_currency":"usdtbsc",'
+    '"order_id":"123456-1700000000","order_description":"café","purchase_id":"5312822613",'
+    '"outcome_amount":10000000000000000.0,"outcome_currency":"usdtbsc",'
+    '"fee":{"currency":"usdtbsc","depositFee":0.000002,"withdrawalFee":0,"serviceFee":0}}'
+).encode("utf-8")
+_IPN_SAMPLE_SIG = (
+    "3d903e3d40d208ffd173a60e381c15e40ceb0c8143793386fa72640516256f00"
+    "d1c25e114178da338246acba44c9f512ea1346d0ed641a809811c58f81da4d65"
+)
+
+# ----------------- OUTBOUND MESSAGES -----------------
+# Notifications to users outside their own update go through this queue instead of
+# being sent inline, so bursts are spread out under Telegram's rate limit.
+OUTBOUND_QUEUE: asyncio.Queue = asyncio.Queue()
+
+def queue_message(chat_id: int, text: str):
+    OUTBOUND_QUEUE.put_nowait({"chat_id": chat_id, "text": text})
+
+async def drain_outbound():
+    while True:
+        batch = [await OUTBOUND_QUEUE.get()]
+        while len(batch) < OUTBOUND_BATCH_SIZE and not OUTBOUND_QUEUE.empty():
+            batch.append(OUTBOUND_QUEUE.get_nowait())
+        started = time.monotonic()
+        results = await asyncio.gather(*(app.bot.send_message(**msg) for msg in batch), return_exceptions=True)
+        for msg, result in zip(batch, results):
+            if isinstance(result, Exception):
+                logger.error(f"Failed to send message to {msg['chat_id']}: {result}")
+        # At most one batch per second
+        await asyncio.sleep(max(0.0, 1.0 - (time.monotonic() - started)))
 
 # ----------------- FASTAPI ENDPOINTS -----------------
 @api.get("/")
 def root():
     return {"ok": True}
 
-# Pydantic model for NowPayments IPN data
+# Pydantic model for NowPayments IPN data; fields we don't use are ignored
 class NowPaymentsIPN(BaseModel):
-    payment_status: str
-    actually_paid: Union[str, float, int]
-    pay_amount: Union[str, float]
-    order_id: str
+    model_config = {"extra": "ignore"}
+
+    payment_status: Optional[str] = None
+    actually_paid: Optional[Union[str, float, int]] = None
+    pay_amount: Optional[Union[str, float]] = None
+    order_id: Optional[str] = None
 
 @api.post("/ipn/nowpayments")
 async def ipn_nowpayments(request: Request, x_nowpayments_sig: str = Header(None)):
+    if not x_nowpayments_sig:
+        raise HTTPException(status_code=400, detail="Bad signature")
     raw = await request.body()
-    if not x_nowpayments_sig or not verify_nowpay_signature(raw, x_nowpayments_sig):
+    if len(raw) > IPN_MAX_BODY:
+        raise HTTPException(status_code=413, detail="Payload too large")
+    valid, body = verify_nowpay_signature(raw, x_nowpayments_sig)
+    if not valid:
         raise HTTPException(status_code=400, detail="Bad signature")
-    data = NowPaymentsIPN(**json.loads(raw.decode("utf-8")))
+    data = NowPaymentsIPN.model_validate(body)
     status = (data.payment_status or "").lower()
     credited = float(data.actually_paid or data.pay_amount or 0.0)
     order_id = data.order_id
@@ -178,12 +408,12 @@ async def ipn_nowpayments(request: Request, x_nowpayments_sig: str = Header(None
         if order_id not in processed_orders:
             try:
                 tg_id = int(str(order_id).split("-")[0])
-                add_balance(tg_id, credited)
-                await app.bot.send_message(chat_id=tg_id, text=f"{credited} USDT Deposit Successfully")
+                add_balance(tg_id, to_units(credited))
                 processed_orders.add(order_id)
-                with open("processed_orders.json", "w") as f:
-                    json.dump(list(processed_orders), f)
+                _orders_log.write(order_id.encode("utf-8") + b"\n")
                 logger.info(f"Processed payment for order_id {order_id}, credited {credited} to user {tg_id}")
+                # Acknowledge NOWPayments right away; the drain task delivers the message
+                queue_message(tg_id, f"{credited} USDT Deposit Successfully")
             except Exception as e:
                 logger.error(f"Error processing payment for order_id {order_id}: {e}")
         else:
@@ -192,18 +422,41 @@ async def ipn_nowpayments(request: Request, x_nowpayments_sig: str = Header(None
 
 @api.post("/telegram/webhook")
 async def telegram_webhook(request: Request):
+    if BOT_USERNAME is None:
+        # initialize_app hasn't succeeded yet; Telegram redelivers on a non-2xx reply
+        raise HTTPException(status_code=503, detail="Bot is starting")
     update = await request.json()
-    await app.process_update(Update.de_json(update, app.bot))
+    # Hand the update to the running application and ack Telegram immediately
+    await app.update_queue.put(Update.de_json(update, app.bot))
     return {"ok": True}
 
+async def register_webhook(webhook_url: str):
+    await app.bot.set_webhook(
+        webhook_url,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+        allowed_updates=WEBHOOK_ALLOWED_UPDATES,
+        drop_pending_updates=False,
+    )
+
+async def webhook_up_to_date(webhook_url: str) -> bool:
+    # Compare everything register_webhook sets, since the webhook may have been deleted,
+    # replaced or registered without these settings outside this process
+    info = await app.bot.get_webhook_info()
+    return (
+        info.url == webhook_url
+        and info.max_connections == WEBHOOK_MAX_CONNECTIONS
+        and set(info.allowed_updates or ()) == set(WEBHOOK_ALLOWED_UPDATES)
+    )
+
 @api.get("/set-webhook")
 async def set_webhook():
     if not BASE_URL:
         raise HTTPException(status_code=400, detail="BASE_URL not set in environment variables")
-    webhook_url = f"{BASE_URL}/telegram/webhook"
     try:
-        await app.bot.set_webhook(webhook_url)
-        return {"status": "Webhook set successfully", "webhook_url": webhook_url}
+        if await webhook_up_to_date(WEBHOOK_URL):
+            return {"status": "Webhook unchanged", "webhook_url": WEBHOOK_URL}
+        await register_webhook(WEBHOOK_URL)
+        return {"status": "Webhook set successfully", "webhook_url": WEBHOOK_URL}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to set webhook: {str(e)}")
 
@@ -221,23 +474,34 @@ WELCOME_TEXT = (
     'Deposit your balance, select your package by sending commands from the menu, and start your earning journey. You can also select multiple packages one by one to boost your earning.'
 )
 
+# Keyboards never change between users, so build them once
+START_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📢 Telegram Channel", url=CHANNEL_URL)]
+])
+
+PACKAGES_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("10 USDT", callback_data="pkg:10"),
+     InlineKeyboardButton("20 USDT", callback_data="pkg:20"),
+     InlineKeyboardButton("50 USDT", callback_data="pkg:50")],
+    [InlineKeyboardButton("100 USDT", callback_data="pkg:100"),
+     InlineKeyboardButton("200 USDT", callback_data="pkg:200"),
+     InlineKeyboardButton("500 USDT", callback_data="pkg:500")],
+    [InlineKeyboardButton("1000 USDT", callback_data="pkg:1000")]
+])
+
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
     referrer = None
     if context.args:
         arg = context.args[0]
-        if arg.startswith("ref"):
-            try:
-                referrer = int(arg[3:])
-                if referrer == update.effective_user.id:
-                    referrer = None
-            except Exception:
-                referrer = None
+        rest = arg.removeprefix("ref")
+        # Only "ref<digits>" is a referral; anything else is skipped without raising
+        if rest != arg and rest.isdecimal():
+            rid = int(rest)
+            if rid != uid:
+                referrer = rid
     ensure_user(uid, referrer)
-    kb = [
-        [InlineKeyboardButton("📢 Telegram Channel", url=f"https://t.me/{CHANNEL_USERNAME.lstrip('@')}")]
-    ]
-    await update.message.reply_text(WELCOME_TEXT, reply_markup=InlineKeyboardMarkup(kb))
+    await update.message.reply_text(WELCOME_TEXT, reply_markup=START_KB)
 
 async def cmd_deposit(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
@@ -247,7 +511,7 @@ async def cmd_deposit(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     if not user.get("deposit_address"):
         try:
-            pay = nowpayments_create_payment(uid)
+            pay = await nowpayments_create_payment(uid)
             pay_address = pay.get("pay_address") or pay.get("wallet_address") or pay.get("payment_address")
             if not pay_address:
                 inv = pay.get("invoice_url") or pay.get("payment_url") or pay.get("url")
@@ -257,7 +521,7 @@ async def cmd_deposit(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await update.message.reply_text("Could not get deposit address. Try again later.")
                 return
             user["deposit_address"] = pay_address
-            save_users()
+            save_user(uid)
             await update.message.reply_text(f"Your receiving address of USDT on BSC (Binance Smart Chain) is given below 👇:")
             await update.message.reply_text(f" {pay_address}")
         except Exception as e:
@@ -266,36 +530,15 @@ async def cmd_deposit(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(f"Your receiving address of USDT on BSC (Binance Smart Chain) is given below 👇:")
         await update.message.reply_text(f" {user['deposit_address']}")
 
-def packages_keyboard():
-    rows = [
-        [InlineKeyboardButton("10 USDT", callback_data="pkg:10"),
-         InlineKeyboardButton("20 USDT", callback_data="pkg:20"),
-         InlineKeyboardButton("50 USDT", callback_data="pkg:50")],
-        [InlineKeyboardButton("100 USDT", callback_data="pkg:100"),
-         InlineKeyboardButton("200 USDT", callback_data="pkg:200"),
-         InlineKeyboardButton("500 USDT", callback_data="pkg:500")],
-        [InlineKeyboardButton("1000 USDT", callback_data="pkg:1000")]
-    ]
-    return InlineKeyboardMarkup(rows)
-
 async def cmd_packages(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("Select a package:", reply_markup=packages_keyboard())
+    await update.message.reply_text("Select a package:", reply_markup=PACKAGES_KB)
 
 async def cb_package(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
     uid = q.from_user.id
-    user = get_user(uid)
-    price = int(q.data.split(":")[1])
-    if price not in PACKAGES:
-        await q.edit_message_text("Invalid package.")
-        return
-    if user.get("balance", 0.0) + 1e-9 < price:
-        await q.edit_message_text("Insufficient balance for selected package")
-        return
-    if not deduct_balance(uid, float(price)):
-        await q.edit_message_text("Insufficient balance for selected package")
-        return
+    # The handler pattern already rejected unknown prices, so the captured group is valid
+    price = int(context.matches[0].group(1))
     daily = PACKAGES[price]
     now = dt.datetime.now(dt.UTC)
     end = now + dt.timedelta(days=PACKAGE_DAYS)
@@ -307,67 +550,57 @@ async def cb_package(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "end_ts": int(end.timestamp()),
         "last_claim_date": None
     }
-    append_package(uid, pack)
-    if not user.get("first_package_activated"):
-        refid = user.get("referrer_id")
-        if refid:
-            bonus = round(price * 0.10, 8)
-            add_balance(refid, bonus)
-        user["first_package_activated"] = True
+    if not activate_package(uid, pack):
+        await q.edit_message_text("Insufficient balance for selected package")
+        return
     await q.edit_message_text(f"Your {price} USDT package has been activated for {PACKAGE_DAYS} days.")
 
 async def cmd_daily_reward(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
     user = get_user(uid)
-    packs = active_packages(user)
+    now_ts = int(time.time())
+    packs = active_packages(user, now_ts)
     if not packs:
         await update.message.reply_text("No active packages.")
         return
-    today = dt.datetime.now(dt.UTC).date().isoformat()
-    total = 0.0
-    changed = False
+    today = time.strftime("%Y-%m-%d", time.gmtime(now_ts))
+    total = 0
     for p in packs:
         if p.get("last_claim_date") == today:
             continue
-        total += float(p["daily"])
+        total += to_units(p["daily"])
         p["last_claim_date"] = today
-        changed = True
     if total <= 0:
         await update.message.reply_text("You already claimed today.")
         return
-    if changed:
-        add_balance(uid, round(total, 8))
-    await update.message.reply_text(f"Daily reward added: {round(total,8)} USDT")
+    add_balance(uid, total)
+    await update.message.reply_text(f"Daily reward added: {from_units(total)} USDT")
 
 async def cmd_my_packages(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
     user = get_user(uid)
-    packs = active_packages(user)
+    packs = active_packages(user, int(time.time()))
     names = [p["name"] for p in packs]
     if not names:
         await update.message.reply_text("You have no active packages.")
         return
-    if len(names) == 1:
-        await update.message.reply_text(f"Your package is {names[0]}")
-    else:
-        await update.message.reply_text(f"Your packages are {', '.join(names)}")
+    await update.message.reply_text(f"Your {'package is' if len(names) == 1 else 'packages are'} {', '.join(names)}")
 
 async def cmd_my_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
     user = get_user(uid)
-    bal = round(user.get("balance", 0.0), 8)
+    bal = from_units(user.get("balance", 0))
     await update.message.reply_text(f"Your current balance is {bal} USDT")
 
 async def cmd_referral_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    bot_info = await context.bot.get_me()
-    link = f"https://t.me/{bot_info.username}?start=ref{uid}"
+    link = f"https://t.me/{BOT_USERNAME}?start=ref{uid}"
     await update.message.reply_text(link)
 
 # ----------------- NEW: MY TEAM COMMAND -----------------
 async def cmd_my_team(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    count = sum(1 for u in users.values() if u.get("referrer_id") == uid and u.get("first_package_activated", False))
+    count = qualified_referrals.get(uid, 0)
     await update.message.reply_text(f"Your qualified friends are {count}")
 
 # ----------------- NEW: WITHDRAWAL SYSTEM -----------------
@@ -389,18 +622,23 @@ async def handle_withdraw_input(update: Update, context: ContextTypes.DEFAULT_TY
     elif user.get("withdraw_state") == "amount":
         try:
             amount = float(message_text)
+            # float() accepts "nan"/"inf"; NaN would slip past both checks below and poison the balance
+            if not math.isfinite(amount):
+                await update.message.reply_text("Invalid amount. Please enter a valid number.")
+                return
             if amount < MIN_WITHDRAWAL:
                 await update.message.reply_text(f"Insufficient withdrawal amount. Minimum is {MIN_WITHDRAWAL} USDT.")
                 user["withdraw_state"] = None
                 user["withdraw_address"] = None
                 return
-            if not deduct_balance(uid, amount):
+            units = to_units(amount)
+            if not deduct_balance(uid, units):
                 await update.message.reply_text("Insufficient balance for withdrawal.")
                 user["withdraw_state"] = None
                 user["withdraw_address"] = None
                 return
             # Calculate qualified friends
-            qualified_friends = sum(1 for u in users.values() if u.get("referrer_id") == uid and u.get("first_package_activated", False))
+            qualified_friends = qualified_referrals.get(uid, 0)
             # Notify admin channel
             if ADMIN_CHANNEL_ID:
                 message = f"New Withdrawal Request:\nUser ID: {uid}\nAddress: {user['withdraw_address']}\nAmount: {amount} USDT\nQualified Friends: {qualified_friends}"
@@ -408,7 +646,7 @@ async def handle_withdraw_input(update: Update, context: ContextTypes.DEFAULT_TY
                     await app.bot.send_message(chat_id=ADMIN_CHANNEL_ID, text=message)
                 except Exception as e:
                     logger.error(f"Failed to send notification to admin channel: {e}")
-                    add_balance(uid, amount)  # Refund if notification fails
+                    add_balance(uid, units)  # Refund if notification fails
                     await update.message.reply_text("Withdrawal request failed. Contact admin.")
                     user["withdraw_state"] = None
                     user["withdraw_address"] = None
@@ -416,50 +654,48 @@ async def handle_withdraw_input(update: Update, context: ContextTypes.DEFAULT_TY
             await update.message.reply_text("Withdraw Successful! Your balance credited to your Binance account within 24 hours.")
             user["withdraw_state"] = None
             user["withdraw_address"] = None
-        except ValueError:
+        except (ValueError, OverflowError):
             await update.message.reply_text("Invalid amount. Please enter a valid number.")
             user["withdraw_state"] = "amount"
             
             # ----------------- SELF-PINGING TASK -----------------
 PING_INTERVAL = 240  # 4 minutes in seconds
 
-def start_ping_task():
-    async def ping_self():
-        while True:
-            try:
-                if not BASE_URL:
-                    logger.error("BASE_URL is not set, cannot ping self")
-                    await asyncio.sleep(PING_INTERVAL)
-                    continue
-                current_time = dt.datetime.now(dt.UTC).strftime("%H:%M:%S UTC")
-                logger.info(f"Pinging self at {BASE_URL} at {current_time}")
-                response = requests.get(f"{BASE_URL}/", timeout=10)
-                response.raise_for_status()
-                logger.info(f"Self-ping successful: {response.status_code} at {current_time}")
-            except requests.exceptions.Timeout:
-                logger.error(f"Self-ping timed out for {BASE_URL} at {current_time}")
-            except requests.exceptions.ConnectionError:
-                logger.error(f"Self-ping connection error for {BASE_URL} at {current_time}")
-            except Exception as e:
-                logger.error(f"Self-ping failed: {str(e)} at {current_time}")
-            await asyncio.sleep(PING_INTERVAL)
-
-    async def run_ping():
-        await ping_self()
-
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    loop.run_until_complete(run_ping())
-
-# Start the ping task in a separate thread
-threading.Thread(target=start_ping_task, daemon=True).start()
+async def ping_self():
+    while True:
+        try:
+            if not BASE_URL:
+                logger.error("BASE_URL is not set, cannot ping self")
+                await asyncio.sleep(PING_INTERVAL)
+                continue
+            current_time = dt.datetime.now(dt.UTC).strftime("%H:%M:%S UTC")
+            logger.info(f"Pinging self at {BASE_URL} at {current_time}")
+            # requests blocks, so run it on the executor and keep the server loop free
+            response = await asyncio.to_thread(requests.get, PING_URL, timeout=10)
+            response.raise_for_status()
+            logger.info(f"Self-ping successful: {response.status_code} at {current_time}")
+        except requests.exceptions.Timeout:
+            logger.error(f"Self-ping timed out for {BASE_URL} at {current_time}")
+        except requests.exceptions.ConnectionError:
+            logger.error(f"Self-ping connection error for {BASE_URL} at {current_time}")
+        except Exception as e:
+            logger.error(f"Self-ping failed: {str(e)} at {current_time}")
+        await asyncio.sleep(PING_INTERVAL)
 
 # ----------------- SETUP & RUN -----------------
-app = Application.builder().token(BOT_TOKEN).build()
+app = (
+    Application.builder()
+    .token(BOT_TOKEN)
+    .connection_pool_size(TELEGRAM_POOL_SIZE)
+    .pool_timeout(TELEGRAM_POOL_TIMEOUT)
+    # Updates come off the queue in parallel, as they did when each webhook request ran its own
+    .concurrent_updates(True)
+    .build()
+)
 app.add_handler(CommandHandler("start", cmd_start))
 app.add_handler(CommandHandler("deposit", cmd_deposit))
 app.add_handler(CommandHandler("packages", cmd_packages))
-app.add_handler(CallbackQueryHandler(cb_package, pattern=r"^pkg:\d+$"))
+app.add_handler(CallbackQueryHandler(cb_package, pattern=PACKAGE_CALLBACK_RE))
 app.add_handler(CommandHandler("daily_reward", cmd_daily_reward))
 app.add_handler(CommandHandler("my_packages", cmd_my_packages))
 app.add_handler(CommandHandler("my_balance", cmd_my_balance))
@@ -469,19 +705,31 @@ app.add_handler(CommandHandler("withdraw", cmd_withdraw))
 app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_withdraw_input))
 
 async def initialize_app():
-    try:
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        await app.initialize()
-        if BASE_URL:
-            webhook_url = f"{BASE_URL}/telegram/webhook"
-            await app.bot.set_webhook(webhook_url)
-            logger.info(f"Webhook set to {webhook_url}")
-        else:
-            logger.warning("BASE_URL not set. Running FastAPI server only. Use /set-webhook to configure Telegram webhook.")
-    except Exception as e:
-        logger.error(f"Error initializing app: {e}")
-        raise
+    global BOT_USERNAME
+    # Both steps are skipped when already done, so a retry after a failed set_webhook
+    # only repeats the webhook registration
+    await app.initialize()
+    if not app.running:
+        await app.start()
+    # initialize() already fetched getMe, so the username costs no extra request
+    BOT_USERNAME = app.bot.username
+    if BASE_URL:
+        await register_webhook(WEBHOOK_URL)
+        logger.info(f"Webhook set to {WEBHOOK_URL}")
+    else:
+        logger.warning("BASE_URL not set. Running FastAPI server only. Use /set-webhook to configure Telegram webhook.")
+
+async def bootstrap_app():
+    attempt = 0
+    while True:
+        try:
+            await initialize_app()
+            return
+        except Exception as e:
+            delay = min(5 * 2 ** attempt, BOOTSTRAP_MAX_BACKOFF)
+            logger.error(f"Error initializing app, retrying in {delay}s: {e}")
+            await asyncio.sleep(delay)
+            attempt += 1
 if __name__ == "__main__":
     missing = []
     for name in ["BOT_TOKEN", "NOWPAY_API_KEY", "NOWPAY_IPN_SECRET"]:
@@ -489,10 +737,10 @@ if __name__ == "__main__":
             missing.append(name)
     if missing:
         raise RuntimeError(f"Missing required config values: {', '.join(missing)}")
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    try:
-        loop.run_until_complete(initialize_app())
-        uvicorn.run(api, host="0.0.0.0", port=PORT, log_level="info", workers=1)
-    finally:
-        loop.close()
+    if not verify_nowpay_signature(_IPN_SAMPLE_BODY, _IPN_SAMPLE_SIG, _IPN_SAMPLE_SECRET)[0]:
+        raise RuntimeError("IPN signature check no longer matches NOWPayments' signing format")
+    # The bot is initialized inside the lifespan, on the same loop that serves requests
+    # No per-request access log: webhook and IPN traffic would write a line to stdout on every hit.
+    # Users and orders live in this process's memory and files, so it runs as a single worker,
+    # and the app object is passed directly so this module isn't imported a second time as "main".
+    uvicorn.run(api, host="0.0.0.0", port=PORT, loop="uvloop", http="httptools", log_level="info", access_log=False)